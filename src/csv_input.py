@@ -0,0 +1,54 @@
+"""csv_input.py: Input handler for CSV files."""
+
+import csv
+import operator
+import logging
+from handlers import BaseInputHandler
+
+log = logging.getLogger('ETL_logger')
+
+
+class CsvInputHandler(BaseInputHandler):
+    """
+    Receives data from a CSV file.
+
+    Places it in the desired order, filtering out unnecessary fields.
+    Positions are byte offsets of the next record.
+    """
+    def __init__(self, file_path: str, fields: tuple, encoding: str = 'utf-8', **fmtparams):
+        self.encoding = encoding
+        self.fmtparams = fmtparams
+        super().__init__(file_path, fields)
+
+    def get_positioned_gen(self, start=None):
+        """Yields (position, row) from the given file incrementally."""
+        with open(self.file_path, 'rb') as csv_input:
+            # the reader takes lines one by one, so the file is right after the last row
+            for row in self._iter_rows(csv_input, start):
+                yield csv_input.tell(), row
+
+    def get_row_gen(self, start=None):
+        """Yields rows from the given file as tuple incrementally."""
+        with open(self.file_path, 'rb') as csv_input:
+            yield from self._iter_rows(csv_input, start)
+
+    def _iter_rows(self, csv_input, start):
+        lines = map(operator.methodcaller('decode', self.encoding), csv_input)
+        dr = csv.DictReader(lines, **self.fmtparams)
+        # grab heading, then skip already processed data
+        if dr.fieldnames is None:
+            return
+        if start is not None:
+            csv_input.seek(start)
+        for d in dr:
+            # delete unnecessary data and order as required
+            # X1,X2..Xn
+            try:
+                nice_data = tuple(d[key] for key in self.fields[0] + self.fields[1])
+            except Exception as ex:
+                msg = f'Unable to load data from csv row! {ex}'
+                detail = f'Input data: {d} Expected: {self.fields[0] + self.fields[1]}'
+                log.warning(msg)
+                log.warning(detail)
+            else:
+                yield nice_data
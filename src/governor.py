@@ -0,0 +1,114 @@
+"""governor.py: Keeps memory usage of the pipeline under the given budget."""
+
+import os
+import sys
+import threading
+import logging
+
+log = logging.getLogger('ETL_logger')
+
+
+def get_rss():
+    """Returns the resident set size of the process, bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # no /proc: peak RSS (KiB on Linux, bytes on macOS) is the best available
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class _Knob:
+    """An integer attribute of a pipeline stage the governor may change."""
+    def __init__(self, obj, attr: str, minimum: int, maximum: int):
+        self.obj = obj
+        self.attr = attr
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def scale(self, factor: float):
+        value = getattr(self.obj, self.attr)
+        new_value = min(self.maximum, max(self.minimum, int(value * factor)))
+        if new_value != value:
+            setattr(self.obj, self.attr, new_value)
+            log.debug(f'{type(self.obj).__name__}.{self.attr}: {value} -> {new_value}')
+
+
+class MemoryGovernor:
+    """
+    Samples RSS in a background thread and adjusts the registered stage attributes.
+
+    Above high * budget all values are halved, below low * budget they grow,
+    so batches stay as large as the budget allows. Stages read the attributes
+    on every batch, so changes take effect while the stage is running.
+    """
+    def __init__(self, budget: int, interval: float = 0.5,
+                 low: float = 0.6, high: float = 0.85):
+        self.budget = budget
+        self.interval = interval
+        self.low = low
+        self.high = high
+        self.peak_rss = 0
+        self._knobs = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def govern(self, obj, attr: str, minimum: int, maximum: int):
+        """Registers obj.attr (e.g. a batch size) to be adjusted within [minimum, maximum]."""
+        with self._lock:
+            self._knobs.append(_Knob(obj, attr, minimum, maximum))
+        return obj
+
+    def release(self, obj):
+        """Stops adjusting attributes of obj."""
+        with self._lock:
+            self._knobs = [knob for knob in self._knobs if knob.obj is not obj]
+
+    def available(self):
+        """Returns the part of the budget not used yet, bytes."""
+        return max(0, self.budget - get_rss())
+
+    def check(self):
+        """Samples RSS once and adjusts the registered attributes."""
+        rss = get_rss()
+        self.peak_rss = max(self.peak_rss, rss)
+        if rss > self.high * self.budget:
+            factor = 0.5
+            log.debug(f'Memory pressure: RSS {rss} of {self.budget} bytes')
+        elif rss < self.low * self.budget:
+            factor = 1.25
+        else:
+            return
+        with self._lock:
+            knobs = list(self._knobs)
+        for knob in knobs:
+            knob.scale(factor)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.check()
+        log.info(f'Peak RSS: {self.peak_rss} bytes, memory budget: {self.budget} bytes')
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
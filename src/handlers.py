@@ -1,11 +1,17 @@
 """handlers.py: A set of classes for working with data of different formats."""
 
+import os
+import io
+import copy
 import sys
 import csv
-import sqlite3
-import xml.etree.ElementTree as et
+import itertools
+import threading
 import logging
-import json_stream
+from pipeline import BackgroundSink, Channel, ReadAhead
+from validation import RowValidator
+# Input handlers of the formats are in csv_input, json_input, ndjson_input
+# and xml_input, they are imported when a file of the format is found, see registry.py
 
 log = logging.getLogger('ETL_logger')
 
@@ -51,105 +57,351 @@ class HeaderType:
         raise NotImplementedError
 
 
-class CsvInputHandler(BaseHandler):
+class UnsortedInputError(Exception):
+    """Rows of a source turned out not to be sorted by the key."""
+
+
+class BaseInputHandler(BaseHandler):
     """
-    Receives data from a CSV file.
+    Base class for data sources.
 
-    Places it in the desired order, filtering out unnecessary fields.
+    Subclasses implement get_positioned_gen, which yields (position, row) pairs.
+    A position points right after its row, so reading can be resumed from it.
     """
-    def __init__(self, file_path: str, fields: tuple, **fmtparams):
-        self.fmtparams = fmtparams
-        super().__init__(file_path, fields)
+    # pipeline.ProcessPool parsing ranges of the file, None: sequential
+    pool = None
+
+    def wants_pool(self):
+        """True if the file is parsed by ranges in the pool, when one is given."""
+        return False
 
-    def get_row_gen(self):
+    @property
+    def source_id(self):
+        """Identifies the source in checkpoints."""
+        return os.path.abspath(self.file_path)
+
+    def get_positioned_gen(self, start=None):
+        raise NotImplementedError
+
+    def get_row_gen(self, start=None):
         """Yields rows from the given file as tuple incrementally."""
-        with open(self.file_path, newline='') as csv_input:
-            dr = csv.DictReader(csv_input, **self.fmtparams)
-            # heading already grabbed by reader, start read data
-            for d in dr:
-                # delete unnecessary data and order as required
-                # X1,X2..Xn
-                try:
-                    nice_data = tuple(d[key] for key in self.fields[0] + self.fields[1])
-                except Exception as ex:
-                    msg = f'Unable to load data from csv row! {ex}'
-                    detail = f'Input data: {d} Expected: {self.fields[0] + self.fields[1]}'
-                    log.warning(msg)
-                    log.warning(detail)
-                else:
-                    yield nice_data
-
-
-class XmlInputHandler(BaseHandler):
-    """Yields "rows" from the given xml file as tuple incrementally."""
-    def get_row_gen(self):
-        """Yields "rows" from the given xml file as tuple incrementally."""
-        data = {}
-        key = None
-        context = et.iterparse(self.file_path, events=("start", "end"))
-        for ev, elem in context:
-            if ev == 'start' and elem.tag == 'objects':
-                data = {}
-            if ev == 'start' and elem.tag == 'object':
-                key = elem.attrib['name']
-            if ev == 'start' and elem.tag == 'value':
-                val = elem.text
-                data[key] = val
-            if ev == 'end' and elem.tag == 'objects':
-                try:
-                    nice_data = tuple(data[key] for key in self.fields[0] + self.fields[1])
-                except Exception as ex:
-                    msg = f'Unable to load data from xml object! {ex}'
-                    detail = f'Input data: {data} Expected: {self.fields[0] + self.fields[1]}'
-                    log.warning(msg)
-                    log.warning(detail)
-                else:
-                    yield nice_data
-
-
-class JsonInputHandler(BaseHandler):
-    """Yields "rows" from the given json file as tuple incrementally."""
-    def get_row_gen(self):
-        """Yields "rows" from the given json file as tuple incrementally."""
-        with open(self.file_path, newline='') as json_input:
-            # array start can be found somewhere in the first QTY charachters
-            QTY = 100
-            array_start = json_input.read(QTY).find('[')
-            json_input.seek(array_start)
-            for d in json_stream.stream_array(json_stream.tokenize(json_input)):
-                try:
-                    nice_data = tuple(str(d[key]) for key in self.fields[0] + self.fields[1])
-                except Exception as ex:
-                    msg = f'Unable to load data from json object! {ex}'
-                    detail = f'Input data: {d} Expected: {self.fields[0] + self.fields[1]}'
-                    log.warning(msg)
-                    log.warning(detail)
-                else:
-                    yield nice_data
+        for _, row in self.get_positioned_gen(start):
+            yield row
+
+    def get_sorted_row_gen(self, key_size: int):
+        """
+        Yields rows, checking that they are sorted by the first key_size values.
+
+        Raises UnsortedInputError at the first violation. Empty values can't be
+        compared the way SQLite orders NULLs, so they are violations too.
+        """
+        prev = None
+        for row in self.get_row_gen():
+            key = row[:key_size]
+            if None in key or (prev is not None and key < prev):
+                raise UnsortedInputError(f'{self.file_path}: {key} after {prev}')
+            prev = key
+            yield row
+
+    def is_sorted_head(self, key_size: int, rows: int = 1000):
+        """Cheap check: returns True if the first rows are sorted by the first key_size values."""
+        # a few rows aren't worth the process pool
+        head = copy.copy(self)
+        head.pool = None
+        it = head.get_sorted_row_gen(key_size)
+        try:
+            for _ in itertools.islice(it, rows):
+                pass
+        except UnsortedInputError:
+            return False
+        finally:
+            it.close()
+        return True
+
+    def get_checkpointed_gen(self, start=None):
+        """Yields (source_id, position, row) incrementally, see DbWriter.write_checkpointed."""
+        source_id = self.source_id
+        for position, row in self.get_positioned_gen(start):
+            yield source_id, position, row
+
+
+def find_in_file(binary_file, pattern: bytes, offset: int, block_size: int = 64 * 1024):
+    """Returns the offset of the first occurrence of pattern at or after offset, or -1."""
+    binary_file.seek(offset)
+    tail = b''
+    while True:
+        block = binary_file.read(block_size)
+        if not block:
+            return -1
+        data = tail + block
+        index = data.find(pattern)
+        if index != -1:
+            return offset - len(tail) + index
+        offset += len(block)
+        # a pattern may be split between blocks
+        tail = data[len(data) - len(pattern) + 1:]
+
+
+def rfind_in_file(binary_file, pattern: bytes, block_size: int = 64 * 1024):
+    """Returns the offset of the last occurrence of pattern in the file, or -1."""
+    end = binary_file.seek(0, os.SEEK_END)
+    head = b''
+    while end > 0:
+        start = max(0, end - block_size)
+        binary_file.seek(start)
+        data = binary_file.read(end - start) + head
+        index = data.rfind(pattern)
+        if index != -1:
+            return start + index
+        end = start
+        head = data[:len(pattern) - 1]
+    return -1
 
 
 class CsvWriter(BaseHandler):
-    """Gets iterable and inserts its items in the given .csv file."""
-    def __init__(self, file_path: str, fields: list, **fmtparams):
+    """
+    Gets iterable and inserts its items in the given .csv file.
+
+    Modes: 'replace' - writes to a temporary file and atomically renames it to the target,
+    'truncate' - overwrites the target, 'append' - appends to the target.
+    Rows are formatted in batches and written with a large buffer.
+    With compress=True the output is gzipped, compression runs in a background thread.
+    """
+    MODES = ('replace', 'truncate', 'append')
+
+    def __init__(self, file_path: str, fields: list, mode: str = 'replace',
+                 compress: bool = False, compresslevel: int = 6,
+                 batch_size: int = 10000, buffer_size: int = 1024 * 1024,
+                 encoding: str = 'utf-8', **fmtparams):
+        if mode not in self.MODES:
+            raise ValueError(f'Unknown mode: {mode}. Expected one of: {self.MODES}')
+        self.mode = mode
+        self.compress = compress
+        self.compresslevel = compresslevel
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.encoding = encoding
         self.fmtparams = fmtparams
         super().__init__(file_path, fields)
 
     def write(self, it, aliases=None):
         """Writes data from iterable incrementally."""
         aliases = aliases if aliases else self.fields[0] + self.fields[1]
-        with open(self.file_path, 'a', newline='') as csv_output:
-            writer = csv.writer(csv_output, **self.fmtparams)
-            writer.writerow(aliases)
-            for row in it:
-                writer.writerow(row)
+        if self.mode == 'replace':
+            import tempfile
+            out_dir, name = os.path.split(os.path.abspath(self.file_path))
+            fd, path = tempfile.mkstemp(prefix=f'.{name}.', suffix='.tmp', dir=out_dir)
+            os.close(fd)
+            # mkstemp creates the file readable by the owner only
+            mode = os.stat(self.file_path).st_mode if os.path.exists(self.file_path) else 0o644
+            os.chmod(path, mode)
+        else:
+            path = self.file_path
+        file_mode = 'ab' if self.mode == 'append' else 'wb'
+        try:
+            with open(path, file_mode, buffering=self.buffer_size) as raw_output:
+                if self.compress:
+                    import gzip
+                    with gzip.GzipFile(fileobj=raw_output, mode=file_mode,
+                                       compresslevel=self.compresslevel) as gz_output, \
+                         BackgroundSink(gz_output.write) as sink:
+                        self._write_rows(it, aliases, sink.write)
+                else:
+                    self._write_rows(it, aliases, raw_output.write)
+        except BaseException:
+            if self.mode == 'replace':
+                os.remove(path)
+            raise
+        if self.mode == 'replace':
+            os.replace(path, self.file_path)
+
+    def _write_rows(self, it, aliases, write_chunk):
+        """Formats rows in batches and passes encoded chunks to write_chunk."""
+        buffer = io.StringIO(newline='')
+        writer = csv.writer(buffer, **self.fmtparams)
+        writer.writerow(aliases)
+        it = iter(it)
+        while True:
+            # may be changed by MemoryGovernor meanwhile
+            batch_size = self.batch_size
+            batch = list(itertools.islice(it, batch_size))
+            writer.writerows(batch)
+            chunk = buffer.getvalue()
+            if chunk:
+                write_chunk(chunk.encode(self.encoding))
+                buffer.seek(0)
+                buffer.truncate()
+            if len(batch) < batch_size:
+                break
+
+
+class PartitionedCsvWriter(BaseHandler):
+    """
+    Gets iterable sorted by D1 and writes it to a directory of .csv files split by D1.
+
+    by='value' - a file per D1 value, by='range' - files of about partition_rows rows,
+    a D1 value is never split between files. Every file is written by a CsvWriter
+    in one of the writer threads while the next partitions are being read,
+    at most 2 * workers partitions are in flight,
+    file names are part-00000{ext}[.gz] in the order of D1.
+    manifest.json in the directory lists the files with their D1 range,
+    row count and size in bytes. The directory is replaced as a whole when complete.
+    """
+    BY = ('value', 'range')
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, dir_path: str, fields: list, by: str = 'value',
+                 partition_rows: int = 1000000, workers: int = 4, queue_size: int = 8,
+                 ext: str = '.csv', compress: bool = False, compresslevel: int = 6,
+                 batch_size: int = 10000, encoding: str = 'utf-8', **fmtparams):
+        if by not in self.BY:
+            raise ValueError(f'Unknown partitioning: {by}. Expected one of: {self.BY}')
+        self.by = by
+        self.partition_rows = partition_rows
+        self.workers = workers
+        self.queue_size = queue_size
+        self.ext = ext
+        self.compress = compress
+        self.compresslevel = compresslevel
+        self.batch_size = batch_size
+        self.encoding = encoding
+        self.fmtparams = fmtparams
+        super().__init__(dir_path, fields)
+
+    def write(self, it, aliases=None):
+        """Writes data from iterable incrementally, returns the manifest."""
+        import json
+        import shutil
+        import tempfile
+        out_dir, name = os.path.split(os.path.abspath(self.file_path))
+        tmp_dir = tempfile.mkdtemp(prefix=f'.{name}.', suffix='.tmp', dir=out_dir)
+        # mkdtemp creates the directory accessible by the owner only
+        os.chmod(tmp_dir, 0o755)
+        try:
+            partitions = self._write_partitions(it, aliases, tmp_dir)
+            manifest = {'fields': list(aliases if aliases else self.fields[0] + self.fields[1]),
+                        'by': self.by,
+                        'rows': sum(p['rows'] for p in partitions),
+                        'bytes': sum(p['bytes'] for p in partitions),
+                        'partitions': partitions}
+            with open(os.path.join(tmp_dir, self.MANIFEST), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=1)
+            self._replace_dir(tmp_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        log.info(f'Written {len(partitions)} partitions, {manifest["rows"]} rows to {self.file_path}')
+        return manifest
+
+    def _replace_dir(self, tmp_dir):
+        """Puts tmp_dir in place of the target, the old directory is removed afterwards."""
+        if os.path.exists(self.file_path):
+            old_dir = tmp_dir + '.old'
+            os.rename(self.file_path, old_dir)
+            os.rename(tmp_dir, self.file_path)
+            import shutil
+            shutil.rmtree(old_dir)
+        else:
+            os.rename(tmp_dir, self.file_path)
+
+    def _write_partitions(self, it, aliases, tmp_dir):
+        """Splits rows into partitions, each one is passed to a writer thread via Channel."""
+        import concurrent.futures
+        ext = self.ext + '.gz' if self.compress else self.ext
+        partitions = []
+        errors = []
+        # partitions waiting for a writer hold their batches in memory
+        in_flight = threading.BoundedSemaphore(2 * self.workers)
+
+        def write_partition(writer, channel):
+            try:
+                writer.write(channel, aliases)
+            except BaseException as ex:
+                errors.append(ex)
+            finally:
+                # unblock the producer
+                channel.drain()
+                in_flight.release()
+
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            channel = partition = None
+            failure = None
+            try:
+                batch = []
+                for row in it:
+                    d1 = row[0]
+                    if partition is None or (d1 != partition['d1_last'] and (
+                            self.by == 'value' or partition['rows'] >= self.partition_rows)):
+                        if partition is not None:
+                            if batch:
+                                channel.put(batch)
+                                batch = []
+                            channel.close()
+                            channel = None
+                        if errors:
+                            break
+                        partition = {'file': f'part-{len(partitions):05d}{ext}',
+                                     'd1_first': d1, 'd1_last': d1, 'rows': 0}
+                        partitions.append(partition)
+                        writer = CsvWriter(os.path.join(tmp_dir, partition['file']), self.fields,
+                                           mode='truncate', compress=self.compress,
+                                           compresslevel=self.compresslevel,
+                                           batch_size=self.batch_size, encoding=self.encoding,
+                                           **self.fmtparams)
+                        channel = Channel(self.queue_size)
+                        # the previous partitions are closed, so their writers can finish
+                        in_flight.acquire()
+                        executor.submit(write_partition, writer, channel)
+                    partition['d1_last'] = d1
+                    partition['rows'] += 1
+                    batch.append(row)
+                    # may be changed by MemoryGovernor meanwhile
+                    if len(batch) >= self.batch_size:
+                        channel.put(batch)
+                        batch = []
+                else:
+                    if batch:
+                        channel.put(batch)
+                if errors:
+                    # the partition being written must not be taken for a complete one
+                    failure = errors[0]
+            except BaseException as ex:
+                failure = ex
+            if channel is not None:
+                channel.close(failure)
+        # the executor has waited for all the writers
+        if failure is None and errors:
+            failure = errors[0]
+        if failure is not None:
+            raise failure
+        for partition in partitions:
+            partition['bytes'] = os.path.getsize(os.path.join(tmp_dir, partition['file']))
+        return partitions
 
 
 class BaseDb(BaseHandler):
     """Provides methods for a very basic SQL injection prevention."""
-    @staticmethod
-    def validate_data(row):
-        for item in row:
-            BaseDb._validate_sql(item)
+    def _connect(self, cache_size: int = None, read_only: bool = False, mmap_size: int = None):
+        """
+        Opens a connection.
+
+        cache_size: SQLite page cache size in bytes, mmap_size: bytes of the file
+        to access via memory mapping instead of read() calls.
+        """
+        # not imported by the runs without the database
+        import sqlite3
+        if read_only:
+            import pathlib
+            uri = pathlib.Path(os.path.abspath(self.file_path)).as_uri() + '?mode=ro'
+            con = sqlite3.connect(uri, uri=True)
+        else:
+            con = sqlite3.connect(self.file_path)
+        if cache_size:
+            # negative value means KiB
+            con.execute(f'PRAGMA cache_size = {-(cache_size // 1024)}')
+        if mmap_size is not None:
+            con.execute(f'PRAGMA mmap_size = {int(mmap_size)}')
+        return con
 
     def validate_fields(self):
         for item in self.fields[0] + self.fields[1]:
@@ -162,15 +414,24 @@ class BaseDb(BaseHandler):
 
 
 class DbWriter(BaseDb):
-    """Gets iterable and inserts its items in the given database."""
-    def __init__(self, file_path: str, fields: list):
+    """
+    Gets iterable and inserts its items in the given database.
+
+    Can record a checkpoint (source, position) with each committed batch,
+    so an interrupted load is resumed instead of started over.
+    Rows are checked by the validator batch by batch, see validation.RowValidator.
+    """
+    def __init__(self, file_path: str, fields: list, validator: RowValidator = None):
         # Commit when exceeded to reduce RAM usage
         self.insert_counter_limit = 1000
+        self.validator = validator if validator is not None else RowValidator(fields)
+        # source_id: (size, mtime) of the input file
+        self._signatures = {}
         super().__init__(file_path, fields)
 
-    def create_table(self):
-        """Creates table."""
-        con = sqlite3.connect(self.file_path)
+    def create_table(self, keep_existing: bool = False):
+        """Creates table. Existing data and checkpoints are kept if keep_existing."""
+        con = self._connect()
         cur = con.cursor()
         try:
             self.validate_fields()
@@ -186,52 +447,260 @@ class DbWriter(BaseDb):
                 columns += ' %s integer, ' % col
             # remove last comma
             columns = columns[:-2]
-            cur.execute('DROP TABLE IF EXISTS important_data')
-            cur.execute(f'CREATE TABLE important_data ({columns})')
+            if not keep_existing:
+                cur.execute('DROP TABLE IF EXISTS important_data')
+                cur.execute('DROP TABLE IF EXISTS etl_checkpoint')
+            cur.execute(f'CREATE TABLE IF NOT EXISTS important_data ({columns})')
+            cur.execute("""CREATE TABLE IF NOT EXISTS etl_checkpoint
+                        (source text PRIMARY KEY, size integer, mtime integer, position integer,
+                        load text)""")
             con.close()
 
+    def load_checkpoints(self, sources):
+        """
+        Returns {source_id: position} committed by the previous load of the given sources.
+
+        Empty if there is nothing to resume (the load was completed or never started),
+        or the input files, the fields or the validation settings have changed since then.
+        """
+        if not os.path.exists(self.file_path):
+            return {}
+        import sqlite3
+        con = self._connect()
+        try:
+            rows = con.execute('SELECT source, size, mtime, position, load FROM etl_checkpoint').fetchall()
+        except sqlite3.OperationalError:
+            # no checkpoints table or one of an older layout
+            return {}
+        finally:
+            con.close()
+        source_ids = {src.source_id for src in sources}
+        checkpoints = {}
+        for source_id, size, mtime, position, load in rows:
+            if load != self._get_load_signature():
+                log.warning('Unable to resume the load, the fields or validation settings have changed')
+                return {}
+            if source_id not in source_ids or (size, mtime) != self._get_signature(source_id):
+                log.warning(f'Unable to resume the load, sources have changed: {source_id}')
+                return {}
+            checkpoints[source_id] = position
+        return checkpoints
+
+    def _get_signature(self, source_id):
+        if source_id not in self._signatures:
+            try:
+                stat = os.stat(source_id)
+            except OSError:
+                self._signatures[source_id] = None
+            else:
+                self._signatures[source_id] = (stat.st_size, stat.st_mtime_ns)
+        return self._signatures[source_id]
+
+    def _get_load_signature(self):
+        """The fields and validation settings the rows are loaded with."""
+        v = self.validator
+        return repr((self.fields, v.text_policy, v.int_policy, v.int_min, v.int_max))
+
+    def _save_checkpoints(self, cur, positions):
+        load = self._get_load_signature()
+        for source_id, position in positions.items():
+            size, mtime = self._get_signature(source_id)
+            cur.execute('INSERT OR REPLACE INTO etl_checkpoint VALUES (?, ?, ?, ?, ?)',
+                        (source_id, size, mtime, position, load))
+
     def write(self, it):
         """Writes data from iterable incrementally."""
-        con = sqlite3.connect(self.file_path)
+        self._write(it, checkpointed=False)
+
+    def write_checkpointed(self, it):
+        """
+        Writes (source_id, position, row) items from iterable incrementally.
+
+        The last position of each source is committed in the same transaction as its rows,
+        the checkpoints are deleted with the last batch, so a completed load isn't resumed.
+        """
+        self._write(it, checkpointed=True)
+
+    def _write(self, it, checkpointed):
+        con = self._connect()
         cur = con.cursor()
-        op_counter = 0
-        for row in it:
-            try:
-                self.validate_data(row)
-            except Exception:
-                msg = f'SQL injection detected! Input: {row}'
-                log.error(msg)
-                continue
-            else:
-                n = len(self.fields[0]) + len(self.fields[1])
-                columns = ' ?, ' * n
-                # remove last comma
-                columns = columns[:-2]
-                cur.execute(f"""INSERT INTO important_data
-                        VALUES ({columns})""", row)
-                op_counter += 1
-            # reduce RAM usage
-            if op_counter == self.insert_counter_limit:
+        n = len(self.fields[0]) + len(self.fields[1])
+        columns = ' ?, ' * n
+        # remove last comma
+        columns = columns[:-2]
+        sql_insert = f"""INSERT INTO important_data
+                        VALUES ({columns})"""
+        it = iter(it)
+        try:
+            while True:
+                # may be changed by MemoryGovernor meanwhile
+                limit = self.insert_counter_limit
+                batch = list(itertools.islice(it, limit))
+                positions = {}
+                if checkpointed:
+                    for source_id, position, _ in batch:
+                        positions[source_id] = position
+                    rows = [item[2] for item in batch]
+                else:
+                    rows = batch
+                cur.executemany(sql_insert, self.validator.validate(rows))
+                last = len(batch) < limit
+                if checkpointed and last:
+                    cur.execute('DELETE FROM etl_checkpoint')
+                else:
+                    self._save_checkpoints(cur, positions)
+                # reduce RAM usage
                 con.commit()
-                op_counter = 0
-        con.commit()
-        con.close()
+                if last:
+                    break
+        finally:
+            # uncommitted rows are discarded
+            con.close()
 
 
 class DbQuery(BaseDb):
-    """Makes SQL queries and provides results incrementally."""
-    def make_basic_query(self):
-        """Yields results of the SQL query incrementally."""
-        con = sqlite3.connect(self.file_path)
-        cur = con.cursor()
-        sql_basic = 'SELECT * FROM "important_data" ORDER BY %s' % self.fields[0][0]
-        for row in cur.execute(sql_basic):
-            yield row
+    """
+    Makes SQL queries and provides results incrementally.
+
+    Reads through read-only connections in batches of fetch_size rows.
+    With workers > 1 the key space is split on D1 boundaries: each range is
+    queried by its own connection in a separate thread, and the results
+    are concatenated in order, so they are the same as for one worker.
+    The cache_size of a query is the memory of SQLite for it: it is split
+    between the connections of the ranges, and the one of every connection
+    between its page cache and memory mapping. heap_limit is set as
+    the soft heap limit of SQLite, which is shared by all connections.
+    """
+    def __init__(self, file_path: str, fields: list, workers: int = 1,
+                 fetch_size: int = 10000, heap_limit: int = None):
+        self.workers = workers
+        self.fetch_size = fetch_size
+        self.heap_limit = heap_limit
+        # 'hash' aggregation falls back to 'sort' when there are more groups
+        self.hash_groups_limit = None
+        # D1 values sampled for the range boundaries
+        self.samples_per_range = 64
+        super().__init__(file_path, fields)
+
+    def _read_connect(self, cache_size: int = None):
+        if cache_size:
+            con = self._connect(cache_size // 2, read_only=True, mmap_size=cache_size // 2)
+        else:
+            con = self._connect(read_only=True, mmap_size=0)
+        if self.heap_limit:
+            con.execute(f'PRAGMA soft_heap_limit = {int(self.heap_limit)}')
+        return con
+
+    def _fetch_batches(self, sql: str, params=(), cache_size: int = None):
+        """Yields lists of rows of the query and closes the connection."""
+        con = self._read_connect(cache_size)
+        try:
+            cur = con.execute(sql, params)
+            while True:
+                # may be changed by MemoryGovernor meanwhile
+                rows = cur.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            con.close()
+
+    def _fetch(self, sql: str, params=(), cache_size: int = None):
+        """Yields rows of the query."""
+        for rows in self._fetch_batches(sql, params, cache_size):
+            yield from rows
 
-    def make_advanced_query(self):
+    def count_rows(self):
+        """Returns the number of loaded rows."""
+        con = self._read_connect()
+        try:
+            return con.execute('SELECT COUNT(*) FROM "important_data"').fetchone()[0]
+        finally:
+            con.close()
+
+    def get_d1_boundaries(self, parts: int):
+        """Returns up to parts - 1 sorted D1 values splitting the rows into ranges of similar size."""
+        if parts < 2:
+            return []
+        import random
+        d1 = self.fields[0][0]
+        con = self._read_connect()
+        try:
+            max_rowid = con.execute('SELECT MAX(rowid) FROM "important_data"').fetchone()[0]
+            if not max_rowid:
+                return []
+            # a fixed seed keeps the ranges the same from run to run
+            rowids = random.Random(0).sample(range(1, max_rowid + 1),
+                                             min(max_rowid, parts * self.samples_per_range))
+            samples = []
+            for rowid in rowids:
+                row = con.execute(f'SELECT "{d1}" FROM "important_data" WHERE rowid = ?',
+                                  (rowid,)).fetchone()
+                if row is not None and row[0] is not None:
+                    samples.append(row[0])
+        finally:
+            con.close()
+        if not samples:
+            return []
+        samples.sort()
+        return sorted({samples[len(samples) * i // parts] for i in range(1, parts)})
+
+    def _get_ranges(self):
+        """Returns (condition, params) for every D1 range, in order."""
+        d1 = self.fields[0][0]
+        boundaries = self.get_d1_boundaries(self.workers)
+        if not boundaries:
+            return [('1', ())]
+        # NULLs go first
+        ranges = [(f'"{d1}" IS NULL OR "{d1}" < ?', (boundaries[0],))]
+        for low, high in zip(boundaries, boundaries[1:]):
+            ranges.append((f'"{d1}" >= ? AND "{d1}" < ?', (low, high)))
+        ranges.append((f'"{d1}" >= ?', (boundaries[-1],)))
+        return ranges
+
+    def _fetch_ranges(self, make_sql, cache_size: int = None):
+        """Runs the query built by make_sql(condition) for every D1 range in parallel."""
+        ranges = self._get_ranges()
+        if len(ranges) == 1:
+            yield from self._fetch(make_sql('1'), cache_size=cache_size)
+            return
+        log.info(f'Querying {len(ranges)} D1 ranges in parallel')
+        # connections share the memory budget
+        cache_size = cache_size // len(ranges) if cache_size else None
+        # batches of rows are passed between threads as they are fetched,
+        # one waits for the consumer in every range
+        readers = [ReadAhead([self._fetch_batches(make_sql(condition), params, cache_size)],
+                             queue_size=1, batch_size=1).start()
+                   for condition, params in ranges]
+        try:
+            for reader in readers:
+                for rows in reader:
+                    yield from rows
+        finally:
+            for reader in readers:
+                reader.stop()
+
+    def make_basic_query(self, cache_size: int = None):
         """Yields results of the SQL query incrementally."""
-        con = sqlite3.connect(self.file_path)
-        cur = con.cursor()
+        def make_sql(condition):
+            # rowid makes the order of equal D1 values the same for any number of ranges
+            return 'SELECT * FROM "important_data" WHERE %s ORDER BY %s, rowid' % (
+                condition, self.fields[0][0])
+        yield from self._fetch_ranges(make_sql, cache_size)
+
+    def make_advanced_query(self, strategy: str = 'sort', cache_size: int = None):
+        """
+        Yields results of the SQL query incrementally.
+
+        Strategies: 'sort' - SQLite groups and sorts the rows,
+        'hash' - groups are summed in memory, see QueryPlanner.
+        """
+        if strategy == 'hash':
+            groups = self._hash_aggregate(cache_size)
+            if groups is not None:
+                yield from self._sorted_groups(groups)
+                return
+            log.warning(f'More than {self.hash_groups_limit} groups, falling back to sort aggregation')
 
         first_cols = second_cols = ''
         for col in self.fields[0]:
@@ -243,9 +712,63 @@ class DbQuery(BaseDb):
         # remove last comma
         second_cols = second_cols[:-2]
 
-        sql_advanced = f"""SELECT {first_cols}, {second_cols}
+        def make_sql(condition):
+            return f"""SELECT {first_cols}, {second_cols}
                   FROM "important_data"
+                  WHERE {condition}
                   GROUP BY {first_cols}
                   ORDER BY {first_cols}"""
-        for row in cur.execute(sql_advanced):
-            yield row
+        yield from self._fetch_ranges(make_sql, cache_size)
+
+    def _hash_aggregate(self, cache_size: int = None):
+        """
+        Sums groups in a dict in one table scan.
+
+        Returns None if hash_groups_limit is exceeded.
+        """
+        n = len(self.fields[0])
+        cols = ', '.join(f'"{col}"' for col in self.fields[0] + self.fields[1])
+        groups = {}
+        rows = self._fetch(f'SELECT {cols} FROM "important_data"', cache_size=cache_size)
+        for row in rows:
+            key = row[:n]
+            sums = groups.get(key)
+            if sums is None:
+                if self.hash_groups_limit is not None and len(groups) >= self.hash_groups_limit:
+                    rows.close()
+                    return None
+                sums = groups[key] = [None] * (len(row) - n)
+            for i, value in enumerate(row[n:]):
+                if value is not None:
+                    value = to_sql_number(value)
+                    sums[i] = value if sums[i] is None else sums[i] + value
+        return groups
+
+    @staticmethod
+    def _sorted_groups(groups):
+        """Yields rows of the advanced result from {key: sums} in key order."""
+        # str comparison gives the same order as SQLite BINARY collation of UTF-8 text
+        try:
+            keys = sorted(groups)
+        except TypeError:
+            # NULLs go first
+            keys = sorted(groups, key=lambda k: tuple((v is not None, v or '') for v in k))
+        for key in keys:
+            yield key + tuple(groups.pop(key))
+
+
+def to_sql_number(value):
+    """Converts a value to a number the way INTEGER column affinity and SQLite SUM do."""
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        number = float(value)
+    except ValueError:
+        # text is summed as 0.0 and makes the sum a float
+        return 0.0
+    # lossless reals are stored as integers
+    return int(number) if number.is_integer() and abs(number) < 2 ** 63 else number
@@ -0,0 +1,109 @@
+"""json_input.py: Input handler for JSON files with an array of objects."""
+
+import codecs
+import itertools
+import functools
+import operator
+import logging
+import json_stream
+from handlers import BaseInputHandler
+
+log = logging.getLogger('ETL_logger')
+
+
+class _OffsetCharReader:
+    """
+    Provides read() for json_stream.tokenize over a binary file.
+
+    Knows the byte offset of the next character (see tell). read is next()
+    over the characters of the decoded chunks, so reading a character costs
+    no Python code; bytes are counted only when tell is called,
+    in an ASCII chunk characters are bytes.
+    """
+    def __init__(self, binary_file, encoding: str, prefix: str = '', chunk_size: int = 64 * 1024):
+        self.file = binary_file
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        # the current chunk, its iterator and characters already counted in self._offset
+        self._text = ''
+        self._chars = iter('')
+        self._counted = 0
+        self._ascii = True
+        self._offset = binary_file.tell()
+        chars = itertools.chain.from_iterable(self._chunks(prefix))
+        # tokenize calls read(1) until it gets '', as from a file
+        self.read = functools.partial(next, itertools.chain(chars, itertools.repeat('')))
+
+    def _chunks(self, prefix):
+        if prefix:
+            # the prefix is read first, but is not a part of the file
+            self._text, self._chars, self._counted = prefix, iter(prefix), len(prefix)
+            self._ascii = False
+            yield self._chars
+        while True:
+            data = self.file.read(self.chunk_size)
+            text = self._decoder.decode(data, final=not data)
+            if text:
+                # count the rest of the previous chunk
+                self.tell()
+                self._text, self._chars, self._counted = text, iter(text), 0
+                self._ascii = text.isascii()
+                yield self._chars
+            if not data:
+                return
+
+    def tell(self):
+        consumed = len(self._text) - operator.length_hint(self._chars)
+        if self._ascii:
+            self._offset += consumed - self._counted
+        else:
+            self._offset += len(self._text[self._counted:consumed].encode(self.encoding))
+        self._counted = consumed
+        return self._offset
+
+
+class JsonInputHandler(BaseInputHandler):
+    """
+    Yields "rows" from the given json file as tuple incrementally.
+
+    Positions are byte offsets right after the processed array element.
+    """
+    def __init__(self, file_path: str, fields: tuple, encoding: str = 'utf-8'):
+        self.encoding = encoding
+        super().__init__(file_path, fields)
+
+    def get_positioned_gen(self, start=None):
+        """Yields (position, row) from the given json file incrementally."""
+        with open(self.file_path, 'rb') as json_input:
+            chars = self._open_chars(json_input, start)
+            for row in self._iter_rows(chars):
+                yield chars.tell(), row
+
+    def get_row_gen(self, start=None):
+        """Yields "rows" from the given json file as tuple incrementally."""
+        with open(self.file_path, 'rb') as json_input:
+            yield from self._iter_rows(self._open_chars(json_input, start))
+
+    def _open_chars(self, json_input, start):
+        if start is None:
+            # array start can be found somewhere in the first QTY charachters
+            QTY = 100
+            array_start = json_input.read(QTY).find(b'[')
+            json_input.seek(array_start)
+            return _OffsetCharReader(json_input, self.encoding)
+        # the rest of the array looks like ",{...},{...}]"
+        json_input.seek(start)
+        return _OffsetCharReader(json_input, self.encoding, prefix='[')
+
+    def _iter_rows(self, chars):
+        for d in json_stream.stream_array(json_stream.tokenize(chars)):
+            try:
+                nice_data = tuple(str(d[key]) for key in self.fields[0] + self.fields[1])
+            except Exception as ex:
+                msg = f'Unable to load data from json object! {ex}'
+                detail = f'Input data: {d} Expected: {self.fields[0] + self.fields[1]}'
+                log.warning(msg)
+                log.warning(detail)
+            else:
+                yield nice_data
@@ -8,16 +8,56 @@ import itertools
 import copy
 import logging
 
-from handlers import (HeaderType, CsvInputHandler,
-                      XmlInputHandler, JsonInputHandler,
-                      CsvWriter, DbWriter, DbQuery)
+from handlers import HeaderType, CsvWriter, PartitionedCsvWriter, DbWriter, DbQuery, UnsortedInputError
+from pipeline import ReadAhead, ReadAheadGroup, ProcessPool, can_fork, run_parallel, fan_out
+from registry import registry
+from planner import LoadProfile, QueryPlanner
+from governor import MemoryGovernor
+from validation import RowValidator, Quarantine
+import presorted
 
 BASE_DIR = Path(__file__).resolve().parent.parent
-# Extract data from
+# Extract data from all the files matching the pattern
 INPUT_DIR = os.path.join(BASE_DIR, 'data_input')
+INPUT_PATTERN = '*'
 # Load data to
 OUTPUT_DIR = os.path.join(BASE_DIR, 'data_output')
 
+# Overlap reading, loading and writing in threads (False: strictly sequential)
+OVERLAPPED = True
+# Threads reading the input files when OVERLAPPED, largest files first;
+# rows are loaded in the order of the files, so the results are reproducible
+READ_WORKERS = 4
+# Batches of rows buffered when OVERLAPPED
+QUEUE_SIZE = 8
+BATCH_SIZE = 1000
+# Processes parsing xml and json lines files by ranges of records, one pool for all files
+PARSE_WORKERS = os.cpu_count() or 1
+# Connections reading the database in parallel, by D1 ranges
+QUERY_WORKERS = min(4, os.cpu_count() or 1)
+# Continue an interrupted load from the checkpoints saved in the database
+RESUME_LOAD = True
+# Memory budget of the whole run, bytes: batch sizes, queue depths
+# and the aggregation strategy are adjusted to stay under it
+MEMORY_BUDGET = 512 * 1024 * 1024
+# Merge inputs sorted by D1 directly into the results, without DB
+PRESORTED_BYPASS = True
+# Results: 'replace' (atomically, via temp file), 'truncate' or 'append'
+OUTPUT_MODE = 'replace'
+# Invalid D values (SQL comment or terminator sequences) and M values (not integers):
+# 'reject' - the row goes to quarantine.tsv, 'repair' - the sequences are removed
+# from D values, M values with an integral number are converted, others become NULL
+TEXT_POLICY = 'reject'
+INT_POLICY = 'reject'
+# Gzip the results
+COMPRESS_OUTPUT = False
+# Split the results into a directory of files by D1: None (one file),
+# 'value' (a file per D1 value) or 'range' (files of about PARTITION_ROWS rows)
+PARTITION_OUTPUT = None
+PARTITION_ROWS = 1000000
+# Threads writing the partitions
+WRITE_WORKERS = 4
+
 # Logging
 log_path = os.path.join(OUTPUT_DIR, 'etl_log.log')
 log_format = "%(asctime)s - %(levelname)s - %(module)s: %(lineno)d - %(message)s"
@@ -27,47 +67,45 @@ log = logging.getLogger('ETL_logger')
 # Define input/output data specifics
 domain_obj = HeaderType('D', 3, 'M', 3)
 
-# Data source 1
-path1 = os.path.join(INPUT_DIR, 'csv_data_1.csv')
-src1 = CsvInputHandler(path1, domain_obj.fields)
-it1_from_csv1 = src1.get_row_gen()
-
-# # Data source 2
-path2 = os.path.join(INPUT_DIR, 'csv_data_2.csv')
-src2 = CsvInputHandler(path2, domain_obj.fields)
-it2_from_csv2 = src2.get_row_gen()
-
-# Data source 3
-path3 = os.path.join(INPUT_DIR, 'json_data.json')
-src3 = JsonInputHandler(path3, domain_obj.fields)
-it3_from_json = src3.get_row_gen()
-
-# # Data source 4
-path4 = os.path.join(INPUT_DIR, 'xml_data.xml')
-src4 = XmlInputHandler(path4, domain_obj.fields)
-it4_from_xml = src4.get_row_gen()
-
-# Combine all sources
-all_sources_it = itertools.chain(it1_from_csv1, it2_from_csv2,
-                                 it3_from_json, it4_from_xml)
-
-# Intermediate results: database
-db_path = os.path.join(OUTPUT_DIR, 'quite_a_few_Gb.sqlite3')
-db = DbWriter(db_path, domain_obj.fields)
-db.create_table()
-log.info('Writing to DB started...')
-db.write(all_sources_it)
-
-query = DbQuery(db_path, domain_obj.fields)
-it_basic = query.make_basic_query()
-it_advanced = query.make_advanced_query()
+# Data sources: every file with a known format, largest first
+all_sources = registry.discover(INPUT_DIR, domain_obj.fields, INPUT_PATTERN)
+log.info(f'Input files found: {len(all_sources)}')
+
+# Large xml and json lines files share one pool, forked before any other thread is started
+pooled_sources = [src for src in all_sources if src.wants_pool()]
+parse_pool = None
+if pooled_sources and PARSE_WORKERS > 1 and can_fork():
+    parse_pool = ProcessPool(PARSE_WORKERS)
+    for src in pooled_sources:
+        src.pool = parse_pool
+
+governor = MemoryGovernor(MEMORY_BUDGET).start()
 
 # Final results
-path_basic = os.path.join(OUTPUT_DIR, 'basic_results.tsv')
-path_advanced = os.path.join(OUTPUT_DIR, 'advanced_results.tsv')
+def make_writer(name):
+    if PARTITION_OUTPUT:
+        # a directory of partitions with manifest.json
+        return PartitionedCsvWriter(os.path.join(OUTPUT_DIR, name), domain_obj.fields,
+                                    by=PARTITION_OUTPUT, partition_rows=PARTITION_ROWS,
+                                    workers=WRITE_WORKERS, queue_size=QUEUE_SIZE, ext='.tsv',
+                                    compress=COMPRESS_OUTPUT, delimiter='\t')
+    ext = '.tsv.gz' if COMPRESS_OUTPUT else '.tsv'
+    return CsvWriter(os.path.join(OUTPUT_DIR, name + ext), domain_obj.fields, mode=OUTPUT_MODE,
+                     compress=COMPRESS_OUTPUT, delimiter='\t')
+
+
+recv_basic = make_writer('basic_results')
+recv_advanced = make_writer('advanced_results')
+governor.govern(recv_basic, 'batch_size', 100, 100000)
+governor.govern(recv_advanced, 'batch_size', 100, 100000)
+
+
+# Rejected rows go to quarantine.tsv
+def make_validator(mode='w'):
+    quarantine = Quarantine(os.path.join(OUTPUT_DIR, 'quarantine.tsv'), domain_obj.fields,
+                            mode=mode, delimiter='\t')
+    return RowValidator(domain_obj.fields, TEXT_POLICY, INT_POLICY, quarantine=quarantine)
 
-recv_basic = CsvWriter(path_basic, domain_obj.fields, delimiter='\t')
-recv_advanced = CsvWriter(path_advanced, domain_obj.fields, delimiter='\t')
 
 # Create a header for the advanced query
 # based on the structure of an existing object
@@ -75,7 +113,94 @@ aliased = copy.deepcopy(domain_obj)
 aliased.second_lit = 'MS'
 aliased.make_heading()
 
-log.info('Writing to csv started...')
-recv_basic.write(it_basic)
-recv_advanced.write(it_advanced, aliases=aliased.plain_fields)
+# Sources sorted by D1 are merged straight into the results
+key_size = len(domain_obj.fields[0])
+bypassed = False
+# appended output can't be taken back if a sort violation is found
+# (partitioned output is always replaced), repaired D values may be out of order
+if (PRESORTED_BYPASS and (OUTPUT_MODE != 'append' or PARTITION_OUTPUT)
+        and TEXT_POLICY != 'repair' and presorted.all_sorted(all_sources, 1)):
+    sorted_iters = [src.get_sorted_row_gen(1) for src in all_sources]
+    readers = None
+    if OVERLAPPED:
+        # one bound for all the sources read at the same time
+        readers = ReadAheadGroup(sorted_iters, QUEUE_SIZE * BATCH_SIZE)
+        governor.govern(readers, 'rows_ahead', 1000, 1000000)
+        sorted_iters = readers.readers
+    validator = make_validator()
+    merged_it = validator.filter(presorted.merge_sources(sorted_iters), BATCH_SIZE)
+    log.info('All sources are sorted, writing to csv without DB...')
+    try:
+        fan_out(merged_it, recv_basic.write,
+                lambda rows: recv_advanced.write(presorted.group_sum(rows, key_size),
+                                                 aliases=aliased.plain_fields))
+    except UnsortedInputError as ex:
+        log.warning(f'Sort violation, falling back to DB: {ex}')
+        # the rows are validated over again
+        validator.close(keep=False)
+    else:
+        bypassed = True
+        validator.close()
+    finally:
+        # the readers and their files aren't kept through the DB load
+        merged_it.close()
+        if readers is not None:
+            readers.stop()
+            governor.release(readers)
+        del sorted_iters, merged_it, readers
+
+if not bypassed:
+    # Intermediate results: database
+    db_path = os.path.join(OUTPUT_DIR, 'quite_a_few_Gb.sqlite3')
+    db = DbWriter(db_path, domain_obj.fields, make_validator())
+    governor.govern(db, 'insert_counter_limit', 100, 100000)
+    checkpoints = db.load_checkpoints(all_sources) if RESUME_LOAD else {}
+    if checkpoints:
+        log.info(f'Resuming the previous load from: {checkpoints}')
+        # rejects of the interrupted load are kept
+        db.validator.quarantine.mode = 'a'
+    db.create_table(keep_existing=bool(checkpoints))
+
+    # Combine all sources, each one from its last committed position,
+    # collecting row counts and the number of distinct D1..Dn combinations
+    profile = LoadProfile(domain_obj.fields)
+    profile.partial = bool(checkpoints)
+    all_iters = [profile.observe(src.get_checkpointed_gen(checkpoints.get(src.source_id)))
+                 for src in all_sources]
+    if OVERLAPPED:
+        all_sources_it = ReadAhead(all_iters, READ_WORKERS, QUEUE_SIZE, BATCH_SIZE, ordered=True)
+        governor.govern(all_sources_it, 'batch_size', 100, 100000)
+        governor.govern(all_sources_it, 'queue_size', 1, 64)
+    else:
+        all_sources_it = itertools.chain(*all_iters)
+
+    log.info('Writing to DB started...')
+    db.write_checkpointed(all_sources_it)
+    db.validator.close()
+
+    # SQLite gets half of the memory left, the other half is for the rows in flight;
+    # the queries share it when they run at the same time
+    sqlite_memory = governor.available() // 2
+    query_memory = sqlite_memory // 2 if OVERLAPPED else sqlite_memory
+    # half of the memory of a connection is its page cache, see DbQuery
+    query = DbQuery(db_path, domain_obj.fields, workers=QUERY_WORKERS,
+                    heap_limit=sqlite_memory // 2)
+    governor.govern(query, 'fetch_size', 100, 100000)
+    plan = QueryPlanner(domain_obj.fields, query_memory).plan(profile, query)
+    query.hash_groups_limit = plan.groups_limit
+    if plan.groups_limit:
+        governor.govern(query, 'hash_groups_limit', 1000, plan.groups_limit)
+    it_basic = query.make_basic_query(cache_size=query_memory)
+    it_advanced = query.make_advanced_query(plan.strategy, cache_size=plan.cache_size)
+
+    log.info('Writing to csv started...')
+    if OVERLAPPED:
+        run_parallel(lambda: recv_basic.write(it_basic),
+                     lambda: recv_advanced.write(it_advanced, aliases=aliased.plain_fields))
+    else:
+        recv_basic.write(it_basic)
+        recv_advanced.write(it_advanced, aliases=aliased.plain_fields)
+if parse_pool is not None:
+    parse_pool.shutdown()
+governor.stop()
 log.info('Completed successfully!')
@@ -0,0 +1,86 @@
+"""ndjson_input.py: Input handler for JSON Lines files (one object per line)."""
+
+import os
+import json
+import logging
+from handlers import BaseInputHandler, find_in_file
+
+log = logging.getLogger('ETL_logger')
+
+
+def _parse_ndjson_range(file_path: str, start: int, end: int, keys: tuple, encoding: str):
+    """
+    Parses the lines found in the byte range of the file, one json object per line.
+
+    May run in a worker process. Returns [(byte offset after the line, row)]
+    and [(message, detail)] for invalid lines, which are skipped one by one.
+    """
+    with open(file_path, 'rb') as ndjson_input:
+        ndjson_input.seek(start)
+        data = ndjson_input.read(end - start)
+    rows = []
+    errors = []
+    offset = start
+    for line in data.splitlines(keepends=True):
+        offset += len(line)
+        if not line.strip():
+            continue
+        try:
+            d = json.loads(line.decode(encoding))
+            nice_data = tuple(str(d[key]) for key in keys)
+        except Exception as ex:
+            errors.append((f'Unable to load data from ndjson line! {ex}',
+                           f'Input data: {line[:1000]!r} Expected: {keys}'))
+        else:
+            rows.append((offset, nice_data))
+    return rows, errors
+
+
+class NdjsonInputHandler(BaseInputHandler):
+    """
+    Yields "rows" from the given json lines file (one object per line) as tuple incrementally.
+
+    The file is read by byte ranges of about chunk_size aligned to line ends,
+    with a pool the ranges are decoded in the process pool.
+    A malformed line is logged and skipped, the rest of the file is loaded.
+    Positions are byte offsets right after the line.
+    """
+    def __init__(self, file_path: str, fields: tuple, encoding: str = 'utf-8',
+                 pool=None, chunk_size: int = 4 * 1024 * 1024):
+        self.encoding = encoding
+        self.pool = pool
+        self.chunk_size = chunk_size
+        super().__init__(file_path, fields)
+
+    def wants_pool(self):
+        # a pool isn't worth it for a single range
+        return os.path.getsize(self.file_path) > self.chunk_size
+
+    def get_line_ranges(self, start: int = 0):
+        """Returns [(start, end)] byte ranges of complete lines from the start offset."""
+        ranges = []
+        with open(self.file_path, 'rb') as ndjson_input:
+            size = ndjson_input.seek(0, os.SEEK_END)
+            pos = start
+            while pos < size:
+                end = find_in_file(ndjson_input, b'\n', pos + self.chunk_size)
+                end = size if end == -1 else end + 1
+                ranges.append((pos, end))
+                pos = end
+        return ranges
+
+    def get_positioned_gen(self, start=None):
+        """Yields (position, row) from the given file incrementally."""
+        keys = self.fields[0] + self.fields[1]
+        ranges = self.get_line_ranges(start or 0)
+        args = ((self.file_path, range_start, range_end, keys, self.encoding)
+                for range_start, range_end in ranges)
+        if self.pool is not None and len(ranges) > 1:
+            results = self.pool.map(_parse_ndjson_range, args)
+        else:
+            results = (_parse_ndjson_range(*arg) for arg in args)
+        for rows, errors in results:
+            for msg, detail in errors:
+                log.warning(msg)
+                log.warning(detail)
+            yield from rows
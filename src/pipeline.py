@@ -0,0 +1,370 @@
+"""pipeline.py: Overlapped (threaded, multiprocess) execution of the ETL stages."""
+
+import queue
+import collections
+import threading
+import logging
+
+log = logging.getLogger('ETL_logger')
+
+# Marks the end of a stream in a queue
+_DONE = object()
+
+
+class ReadAhead:
+    """
+    Runs row generators in background threads.
+
+    Each of the worker threads takes the next generator in the given order
+    and passes its rows to the consumer in batches through a bounded queue,
+    so parsing overlaps with the work of the consumer. Rows of one generator
+    keep their order, rows of generators read by different workers are interleaved:
+    with one worker the result is the same as the one of itertools.chain.
+    With ordered=True every generator has its own queue and the result is
+    the same as the one of itertools.chain for any number of workers;
+    workers read at most 2 * workers generators ahead of the consumer.
+    """
+    def __init__(self, iterables, workers: int = 1, queue_size: int = 8,
+                 batch_size: int = 1000, ordered: bool = False):
+        self._iterables = collections.deque(enumerate(iterables))
+        self.batch_size = batch_size
+        self.ordered = ordered
+        count = len(self._iterables) if ordered else 1
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(count)]
+        self._stop = threading.Event()
+        self._errors = []
+        self._threads = [threading.Thread(target=self._produce, daemon=True)
+                         for _ in range(max(1, min(workers, len(self._iterables))))]
+        # generators read but not consumed yet, their batches wait in memory
+        self._ahead = threading.Semaphore(2 * len(self._threads))
+        self._started = False
+
+    @property
+    def queue_size(self):
+        return self._queues[0].maxsize if self._queues else 0
+
+    @queue_size.setter
+    def queue_size(self, value: int):
+        # checked by the queue on every put
+        for q in self._queues:
+            q.maxsize = value
+
+    def start(self):
+        """Starts reading in the background."""
+        if not self._started:
+            self._started = True
+            for thread in self._threads:
+                thread.start()
+        return self
+
+    def stop(self):
+        """Asks the reader threads to finish as soon as possible."""
+        self._stop.set()
+
+    def _put(self, q, item):
+        # don't block forever if the consumer has gone
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            else:
+                return True
+        return False
+
+    def _produce(self):
+        q = None if self.ordered else self._queues[0]
+        try:
+            while not self._stop.is_set():
+                if self.ordered and not self._ahead.acquire(timeout=0.1):
+                    continue
+                try:
+                    index, it = self._iterables.popleft()
+                except IndexError:
+                    return
+                if self.ordered:
+                    q = self._queues[index]
+                batch = []
+                for row in it:
+                    batch.append(row)
+                    if len(batch) >= self.batch_size:
+                        if not self._put(q, batch):
+                            return
+                        batch = []
+                if batch:
+                    self._put(q, batch)
+                if self.ordered:
+                    self._put(q, _DONE)
+                    q = None
+        except Exception as ex:
+            self._errors.append(ex)
+        finally:
+            # the stream of the worker, or the generator it was reading, ends also after an error
+            if q is not None:
+                self._put(q, _DONE)
+
+    def __iter__(self):
+        """Yields rows as they are produced."""
+        self.start()
+        try:
+            if self.ordered:
+                # workers take generators in order: the one read here has been taken already
+                # or is the next one, so waiting for it can't block the workers forever
+                streams = [(q, 1) for q in self._queues]
+            else:
+                streams = [(self._queues[0], len(self._threads))]
+            for q, ends in streams:
+                done = 0
+                while done < ends:
+                    batch = q.get()
+                    if self._errors:
+                        raise self._errors[0]
+                    if batch is _DONE:
+                        done += 1
+                        continue
+                    yield from batch
+                if self.ordered:
+                    self._ahead.release()
+        finally:
+            self.stop()
+
+
+class ReadAheadGroup:
+    """
+    Runs row generators consumed side by side (e.g. merged) in background threads.
+
+    Every generator gets its own ReadAhead with a queue of one batch.
+    The rows read ahead of the consumer are bounded by rows_ahead in total:
+    the batch size is split between the generators, so the memory
+    doesn't grow with their number (down to batches of 100 rows,
+    smaller ones cost more in queue handoffs than they save).
+    """
+    def __init__(self, iterables, rows_ahead: int = 8000):
+        self.readers = [ReadAhead([it], 1, 1) for it in iterables]
+        self.rows_ahead = rows_ahead
+
+    @property
+    def rows_ahead(self):
+        return self._rows_ahead
+
+    @rows_ahead.setter
+    def rows_ahead(self, value: int):
+        self._rows_ahead = value
+        # a batch being read, one in the queue and one being consumed
+        batch_size = max(100, value // (3 * max(1, len(self.readers))))
+        for reader in self.readers:
+            reader.batch_size = batch_size
+
+    def stop(self):
+        """Asks all reader threads to finish as soon as possible."""
+        for reader in self.readers:
+            reader.stop()
+
+
+def run_parallel(*tasks):
+    """Runs callables in separate threads, waits for all of them and re-raises the first error."""
+    errors = []
+
+    def wrapper(task):
+        try:
+            task()
+        except Exception as ex:
+            log.error(f'Task {task} failed! {ex}')
+            errors.append(ex)
+
+    threads = [threading.Thread(target=wrapper, args=(task,)) for task in tasks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+class BackgroundSink:
+    """
+    Passes written chunks to the given function in a background thread.
+
+    Used to offload work that releases the GIL (compression, disk writes)
+    from the thread producing the data.
+    """
+    def __init__(self, func, queue_size: int = 8):
+        self.func = func
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._consume, daemon=True)
+        self._thread.start()
+
+    def _consume(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is _DONE:
+                return
+            if self._error is None:
+                try:
+                    self.func(chunk)
+                except Exception as ex:
+                    # keep draining the queue, so the producer is never blocked
+                    self._error = ex
+
+    def write(self, chunk):
+        """Queues the chunk, blocks while the queue is full."""
+        if self._error is not None:
+            raise self._error
+        self._queue.put(chunk)
+
+    def close(self):
+        """Waits until all queued chunks are processed."""
+        self._queue.put(_DONE)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Channel:
+    """
+    A bounded queue of batches from one producer thread to one consumer thread.
+
+    The consumer iterates the channel. close(error) ends the stream,
+    the error (if any) is raised in the consumer.
+    """
+    def __init__(self, queue_size: int = 8):
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._closed = False
+
+    def put(self, batch):
+        self._queue.put(batch)
+
+    def close(self, error: BaseException = None):
+        if error is not None:
+            self._queue.put(error)
+        self._queue.put(_DONE)
+
+    def __iter__(self):
+        while True:
+            batch = self._queue.get()
+            if batch is _DONE:
+                self._closed = True
+                return
+            if isinstance(batch, BaseException):
+                raise batch
+            yield from batch
+
+    def drain(self):
+        """Skips the rest of the stream, so a failed consumer doesn't block the producer."""
+        while not self._closed:
+            self._closed = self._queue.get() is _DONE
+
+
+def fan_out(it, *consumers, queue_size: int = 8, batch_size: int = 1000):
+    """
+    Passes every item of the iterable to each of the consumers in one pass.
+
+    A consumer is a function taking an iterable, every consumer runs in its own thread.
+    If the iterable raises, the consumers get the same error from their iterables.
+    Waits for all consumers and re-raises the first error.
+    """
+    channels = [Channel(queue_size) for _ in consumers]
+    errors = []
+
+    def consume(consumer, channel):
+        try:
+            consumer(channel)
+        except BaseException as ex:
+            errors.append(ex)
+        finally:
+            # unblock the producer
+            channel.drain()
+
+    def put_all(batch):
+        for channel in channels:
+            channel.put(batch)
+
+    threads = [threading.Thread(target=consume, args=(consumer, channel), daemon=True)
+               for consumer, channel in zip(consumers, channels)]
+    for thread in threads:
+        thread.start()
+    failure = None
+    try:
+        batch = []
+        for item in it:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                put_all(batch)
+                batch = []
+                if errors:
+                    break
+        else:
+            if batch:
+                put_all(batch)
+        if errors:
+            # the other consumers must not take a partial stream for a complete one
+            failure = errors[0]
+    except BaseException as ex:
+        failure = ex
+        errors.insert(0, ex)
+    for channel in channels:
+        channel.close(failure)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def can_fork():
+    """Process pools here need the 'fork' start method: main.py is not importable by a child."""
+    import multiprocessing
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+class ProcessPool:
+    """
+    A pool of forked worker processes shared by all the input handlers.
+
+    Create it once, before other threads are started: the workers are forked
+    right away, so they don't inherit locks held by reader or governor threads.
+    """
+    def __init__(self, workers: int):
+        # not imported by the runs without a pool
+        import multiprocessing
+        import concurrent.futures
+        self.workers = workers
+        context = multiprocessing.get_context('fork')
+        self._executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=context)
+        # with 'fork' all the workers are started on the first submit
+        self._executor.submit(int).result()
+
+    def map(self, func, args, window: int = None):
+        """
+        Yields func(*arg) for every arg tuple of the iterable, in order.
+
+        At most window calls (2 * workers by default) of this map are in flight,
+        so memory is bounded.
+        """
+        window = window or 2 * self.workers
+        futures = collections.deque()
+        try:
+            for arg in args:
+                futures.append(self._executor.submit(func, *arg))
+                if len(futures) >= window:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def shutdown(self):
+        self._executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
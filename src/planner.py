@@ -0,0 +1,149 @@
+"""planner.py: Profiling of the loaded data and choosing how to query it."""
+
+import sys
+import math
+import logging
+from collections import namedtuple
+
+log = logging.getLogger('ETL_logger')
+
+QueryPlan = namedtuple('QueryPlan', 'strategy rows groups group_size cache_size groups_limit')
+
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct hashable items using 2**precision registers.
+
+    The standard error is about 1.04 / sqrt(2**precision): 0.8% for the default precision.
+    Python's hash is used, so sketches are comparable within one process only.
+    """
+    def __init__(self, precision: int = 14):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+        # hash bits left after taking the register index
+        self._rest_bits = 64 - precision
+        self._rest_mask = (1 << self._rest_bits) - 1
+
+    def add(self, item):
+        h = hash(item) & 0xFFFFFFFFFFFFFFFF
+        index = h >> self._rest_bits
+        # position of the leftmost 1-bit in the rest of the hash
+        rank = self._rest_bits - (h & self._rest_mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, *others):
+        """Adds items of other sketches of the same precision, in one pass over the registers."""
+        self.registers = bytearray(map(max, self.registers, *(other.registers for other in others)))
+
+    def count(self):
+        """Returns the estimated number of distinct items."""
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        # registers by value: a few scans in C instead of one Python call per register
+        counts = [self.registers.count(r) for r in range(max(self.registers) + 1)]
+        estimate = alpha * m * m / sum(count * 2.0 ** -r for r, count in enumerate(counts))
+        zeros = counts[0]
+        if estimate <= 2.5 * m and zeros:
+            # small range correction: linear counting
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class LoadProfile:
+    """Row counts and cardinality sketches of the D-key per source, collected during extraction."""
+    def __init__(self, fields: tuple, precision: int = 14):
+        self.fields = fields
+        self.precision = precision
+        # source_id: number of rows
+        self.rows = {}
+        # source_id: HyperLogLog of D1..Dn combinations
+        self.sketches = {}
+        # one of the keys, to estimate the size of groups
+        self.sample_key = None
+        # True if some rows were loaded by a previous run and weren't observed
+        self.partial = False
+
+    def observe(self, it):
+        """Passes (source_id, position, row) items through, profiling the rows."""
+        n = len(self.fields[0])
+        source_id = None
+        rows = 0
+        sketch = HyperLogLog(self.precision)
+        add = sketch.add
+        try:
+            for item in it:
+                if source_id is None:
+                    source_id = item[0]
+                    self.sample_key = item[2][:n]
+                add(item[2][:n])
+                rows += 1
+                yield item
+        finally:
+            if source_id is not None:
+                self.rows[source_id] = rows
+                self.sketches[source_id] = sketch
+
+    @property
+    def total_rows(self):
+        return sum(self.rows.values())
+
+    def distinct_keys(self):
+        """Returns the estimated number of distinct D1..Dn combinations over all sources."""
+        merged = HyperLogLog(self.precision)
+        merged.merge(*self.sketches.values())
+        return merged.count()
+
+
+class QueryPlanner:
+    """
+    Chooses how to compute the advanced result.
+
+    'hash': SQLite only scans the table, groups are summed in a dict and sorted at the end.
+    'sort': SQLite groups the sorted rows, all the memory budget goes to SQLite, see DbQuery.
+    """
+    # Hash table overhead is underestimated by getsizeof
+    SAFETY_FACTOR = 1.5
+    # SQLite page cache for a plain table scan, bytes
+    SCAN_CACHE_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, fields: tuple, memory_budget: int):
+        self.fields = fields
+        self.memory_budget = memory_budget
+
+    def estimate_group_size(self, sample_key):
+        """Estimates the memory of one group in the hash table, bytes."""
+        if sample_key is None:
+            sample_key = ('',) * len(self.fields[0])
+        sums = [0] * len(self.fields[1])
+        # key + its strings + list of sums + its ints + a dict slot
+        size = sys.getsizeof(sample_key) + sum(sys.getsizeof(v) for v in sample_key)
+        size += sys.getsizeof(sums) + len(sums) * sys.getsizeof(2 ** 40) + 3 * 8
+        return size
+
+    def plan(self, profile: LoadProfile, query):
+        """Returns QueryPlan based on the profile, query is used if the profile is partial."""
+        if profile.partial:
+            # earlier rows weren't observed: assume every row is a separate group
+            rows = query.count_rows()
+            groups = max(rows, profile.distinct_keys())
+        else:
+            rows = profile.total_rows
+            groups = profile.distinct_keys()
+        group_size = self.estimate_group_size(profile.sample_key)
+        hash_memory = groups * group_size * self.SAFETY_FACTOR
+        if hash_memory + self.SCAN_CACHE_SIZE <= self.memory_budget:
+            # spill to 'sort' if the estimate turns out to be wrong
+            groups_limit = int((self.memory_budget - self.SCAN_CACHE_SIZE)
+                               / (group_size * self.SAFETY_FACTOR))
+            plan = QueryPlan('hash', rows, groups, group_size, self.SCAN_CACHE_SIZE, groups_limit)
+        else:
+            plan = QueryPlan('sort', rows, groups, group_size, self.memory_budget, None)
+        msg = (f'Query plan: {plan.strategy} aggregation. Estimated rows: {rows}, '
+               f'groups: {groups} x {group_size} bytes, hash table: {int(hash_memory)} bytes, '
+               f'memory budget: {self.memory_budget} bytes, SQLite cache: {plan.cache_size} bytes')
+        log.info(msg)
+        if profile.partial:
+            log.info(f'Profile is partial (resumed load), per source rows: {profile.rows}')
+        return plan
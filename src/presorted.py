@@ -0,0 +1,57 @@
+"""presorted.py: Results for sources already sorted by D1, without the database."""
+
+import heapq
+import logging
+
+from handlers import to_sql_number
+
+log = logging.getLogger('ETL_logger')
+
+
+def all_sorted(sources, key_size: int, probe_rows: int = 1000):
+    """Cheap check of the first rows of every source, see BaseInputHandler.is_sorted_head."""
+    for src in sources:
+        if not src.is_sorted_head(key_size, probe_rows):
+            log.info(f'Source is not sorted by the key: {src.file_path}')
+            return False
+    return True
+
+
+def merge_sources(iterables):
+    """
+    Merges rows of iterables sorted by D1 into one stream sorted by D1 (k-way merge).
+
+    Rows with the same D1 keep the order of the iterables, then their own order,
+    i.e. the load order, as ORDER BY D1, rowid of the database gives them.
+    """
+    return heapq.merge(*iterables, key=lambda row: row[0])
+
+
+def group_sum(rows, key_size: int):
+    """
+    Yields (D1..Dn, SUM(M1)..SUM(Mm)) ordered by D1..Dn for rows sorted by D1.
+
+    The groups are collected for one D1 value at a time.
+    Values are summed the way SQLite does it, see to_sql_number.
+    """
+    d1 = None
+    groups = {}
+    for row in rows:
+        if row[0] != d1:
+            yield from _flush(groups)
+            d1 = row[0]
+        key = row[:key_size]
+        sums = groups.get(key)
+        if sums is None:
+            sums = groups[key] = [None] * (len(row) - key_size)
+        for i, value in enumerate(row[key_size:]):
+            if value is not None:
+                value = to_sql_number(value)
+                sums[i] = value if sums[i] is None else sums[i] + value
+    yield from _flush(groups)
+
+
+def _flush(groups):
+    for key in sorted(groups):
+        yield key + tuple(groups[key])
+    groups.clear()
@@ -0,0 +1,115 @@
+"""registry.py: Lazy lookup of input handlers by file extension or content."""
+
+import os
+import glob
+import json
+import importlib
+import logging
+
+log = logging.getLogger('ETL_logger')
+
+
+class HandlerRegistry:
+    """
+    Maps input files to handler classes.
+
+    Handlers are registered by 'module:Class' names and imported only when
+    a matching file is found, so a job doesn't pay for formats it doesn't read.
+    Files with an unknown extension are recognized by their first bytes.
+    """
+    # bytes read to sniff the format
+    SNIFF_SIZE = 512
+
+    def __init__(self):
+        # '.ext': 'module:Class'
+        self._by_extension = {}
+        # (sniff function, 'module:Class'), checked in the order of registration
+        self._sniffers = []
+        # 'module:Class': class
+        self._loaded = {}
+
+    def register(self, handler_name: str, extensions=(), sniff=None):
+        """
+        Registers a handler.
+
+        sniff: optional function that gets the first bytes of a file
+        and returns True if the file is in the handler's format.
+        """
+        for ext in extensions:
+            self._by_extension[ext.lower()] = handler_name
+        if sniff is not None:
+            self._sniffers.append((sniff, handler_name))
+
+    def _load(self, handler_name: str):
+        if handler_name not in self._loaded:
+            module_name, class_name = handler_name.split(':')
+            module = importlib.import_module(module_name)
+            self._loaded[handler_name] = getattr(module, class_name)
+        return self._loaded[handler_name]
+
+    def find_handler_name(self, file_path: str):
+        """Returns 'module:Class' of the handler for the given file or None."""
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext in self._by_extension:
+            return self._by_extension[ext]
+        try:
+            with open(file_path, 'rb') as f:
+                head = f.read(self.SNIFF_SIZE)
+        except OSError:
+            return None
+        for sniff, handler_name in self._sniffers:
+            if sniff(head):
+                return handler_name
+        return None
+
+    def get_handler(self, file_path: str, fields: tuple, **kwargs):
+        """Returns a handler instance for the given file, raises ValueError if unknown."""
+        handler_name = self.find_handler_name(file_path)
+        if handler_name is None:
+            raise ValueError(f'No input handler for the file: {file_path}')
+        return self._load(handler_name)(file_path, fields, **kwargs)
+
+    def discover(self, input_dir: str, fields: tuple, pattern: str = '*', handler_options=None):
+        """
+        Returns handlers for all files in input_dir matching the glob pattern.
+
+        Files without a handler are skipped. Handlers are sorted by file size,
+        largest first, so the biggest files are started first by the readers.
+        handler_options: {'Class': {keyword arguments of the handler}}.
+        """
+        handler_options = handler_options or {}
+        paths = sorted(p for p in glob.glob(os.path.join(input_dir, pattern)) if os.path.isfile(p))
+        handlers = []
+        for path in paths:
+            handler_name = self.find_handler_name(path)
+            if handler_name is None:
+                log.warning(f'Skipping the file, no input handler: {path}')
+                continue
+            options = handler_options.get(handler_name.split(':')[1], {})
+            handlers.append(self.get_handler(path, fields, **options))
+        handlers.sort(key=lambda h: os.path.getsize(h.file_path), reverse=True)
+        return handlers
+
+
+def _sniff_xml(head: bytes):
+    return head.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'<')
+
+
+def _sniff_ndjson(head: bytes):
+    first_line = head.lstrip(b'\xef\xbb\xbf \t\r\n').split(b'\n', 1)[0]
+    try:
+        return isinstance(json.loads(first_line), dict)
+    except ValueError:
+        return False
+
+
+def _sniff_json(head: bytes):
+    return head.lstrip(b'\xef\xbb\xbf \t\r\n')[:1] in (b'{', b'[')
+
+
+registry = HandlerRegistry()
+registry.register('csv_input:CsvInputHandler', extensions=('.csv',))
+# json lines are sniffed before json: both start with '{'
+registry.register('ndjson_input:NdjsonInputHandler', extensions=('.ndjson', '.jsonl'), sniff=_sniff_ndjson)
+registry.register('json_input:JsonInputHandler', extensions=('.json',), sniff=_sniff_json)
+registry.register('xml_input:XmlInputHandler', extensions=('.xml',), sniff=_sniff_xml)
@@ -0,0 +1,221 @@
+"""validation.py: Batch validation and cleansing of the extracted rows."""
+
+import os
+import re
+import csv
+import itertools
+import threading
+import collections
+import logging
+
+log = logging.getLogger('ETL_logger')
+
+# SQL comment and statement terminator sequences, not allowed in D values
+_UNSAFE_TEXT = re.compile(r'--|/\*\*/|;')
+# an M value
+_INT = re.compile(r'[ \t]*[+-]?[0-9]+[ \t]*')
+# a column of M values as str(int) makes them, joined by '\n' with a trailing one;
+# up to 18 digits can't be out of the SQLite range
+_INT_COLUMN = re.compile(r'(?:(?:0|-?[1-9][0-9]{0,17})\n)*')
+# SQLite INTEGER range
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+
+
+class Quarantine:
+    """
+    Writes rejected rows with the reason to a .csv file.
+
+    The file is opened on the first reject. With mode='w' a file left
+    by an earlier run is removed on close if nothing was rejected.
+    """
+    def __init__(self, file_path: str, fields: tuple, mode: str = 'w',
+                 encoding: str = 'utf-8', **fmtparams):
+        self.file_path = file_path
+        self.fields = fields
+        self.mode = mode
+        self.encoding = encoding
+        self.fmtparams = fmtparams
+        self.rows = 0
+        self._file = None
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def write(self, rejects):
+        """Writes (row, reason) pairs."""
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.file_path, self.mode, newline='', encoding=self.encoding)
+                self._writer = csv.writer(self._file, **self.fmtparams)
+                if self._file.tell() == 0:
+                    self._writer.writerow(list(self.fields[0]) + list(self.fields[1]) + ['reason'])
+            self._writer.writerows(list(row) + [reason] for row, reason in rejects)
+            self.rows += len(rejects)
+
+    def close(self, keep: bool = True):
+        """Closes the file, keep=False removes it (e.g. the stage is run over again)."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if not keep or (self.mode == 'w' and not self.rows):
+                if os.path.exists(self.file_path):
+                    os.remove(self.file_path)
+
+
+class RowValidator:
+    """
+    Checks and cleans batches of rows before they are loaded.
+
+    D values must be text without SQL comment or terminator sequences,
+    M values must be integers within [int_min, int_max].
+    A batch is checked column by column, one regex over the joined values
+    of a column, so a clean batch costs a few passes in C and is passed as is.
+    Rows are examined one by one only in a batch with a problem or an M value
+    not in the canonical form (e.g. ' 01'), such values are converted to int.
+
+    Policies: 'reject' - the row is dropped and passed to the quarantine,
+    'repair' - unsafe sequences are removed from a D value (missing one becomes ''),
+    an M value with an integral number is converted, any other becomes NULL.
+    """
+    POLICIES = ('reject', 'repair')
+
+    def __init__(self, fields: tuple, text_policy: str = 'reject', int_policy: str = 'reject',
+                 int_min: int = INT_MIN, int_max: int = INT_MAX, quarantine: Quarantine = None):
+        for policy in (text_policy, int_policy):
+            if policy not in self.POLICIES:
+                raise ValueError(f'Unknown policy: {policy}. Expected one of: {self.POLICIES}')
+        self.fields = fields
+        self.text_policy = text_policy
+        self.int_policy = int_policy
+        self.int_min = int_min
+        self.int_max = int_max
+        self.quarantine = quarantine
+        self._names = tuple(fields[0]) + tuple(fields[1])
+        self._n_text = len(fields[0])
+        self.rows = 0
+        self.rejected = 0
+        self.repaired = 0
+        # 'column: problem': number of rows
+        self.problems = collections.Counter()
+
+    def validate(self, rows):
+        """Returns the valid and repaired rows of the batch."""
+        if not rows:
+            return []
+        self.rows += len(rows)
+        n = self._n_text
+        try:
+            columns = list(zip(*rows))
+            if len(columns) == len(self._names) and all(len(row) == len(columns) for row in rows):
+                # no separator can join parts of two values into an unsafe sequence
+                text = '\0'.join(itertools.chain.from_iterable(columns[:n]))
+                if _UNSAFE_TEXT.search(text) is None and all(
+                        self._is_int_column(column) for column in columns[n:]):
+                    return rows
+        except TypeError:
+            # values other than str
+            pass
+        return self._validate_rows(rows)
+
+    def filter(self, it, batch_size: int = 1000):
+        """Yields the valid and repaired rows of the iterable, validated in batches."""
+        it = iter(it)
+        while True:
+            batch = list(itertools.islice(it, batch_size))
+            yield from self.validate(batch)
+            if len(batch) < batch_size:
+                return
+
+    def _is_int_column(self, column):
+        """True if every value of the column is a canonical integer within the range."""
+        if _INT_COLUMN.fullmatch('\n'.join(column) + '\n') is None:
+            return False
+        if (self.int_min, self.int_max) == (INT_MIN, INT_MAX):
+            return True
+        ints = list(map(int, column))
+        return self.int_min <= min(ints) and max(ints) <= self.int_max
+
+    def _to_int(self, value):
+        if isinstance(value, int) and not isinstance(value, bool):
+            number = value
+        elif isinstance(value, str) and _INT.fullmatch(value):
+            number = int(value)
+        else:
+            raise ValueError('not an integer')
+        if not self.int_min <= number <= self.int_max:
+            raise ValueError('out of range')
+        return number
+
+    def _repair_int(self, value):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+        if number.is_integer() and self.int_min <= number <= self.int_max:
+            return int(number)
+        return None
+
+    @staticmethod
+    def _repair_text(value):
+        text = '' if value is None else str(value)
+        # removing one sequence may join another one
+        while _UNSAFE_TEXT.search(text):
+            text = _UNSAFE_TEXT.sub('', text)
+        return text
+
+    def _validate_rows(self, rows):
+        valid = []
+        rejects = []
+        for row in rows:
+            problem, values = self._validate_row(row)
+            if problem is None:
+                valid.append(values)
+                continue
+            self.problems[problem] += 1
+            if values is None:
+                self.rejected += 1
+                rejects.append((row, problem))
+            else:
+                self.repaired += 1
+                valid.append(values)
+        if rejects and self.quarantine is not None:
+            self.quarantine.write(rejects)
+        return valid
+
+    def _validate_row(self, row):
+        """Returns (problem, values): (None, row) if valid, values is None if rejected."""
+        if len(row) != len(self._names):
+            return 'wrong number of values', None
+        problem = None
+        values = list(row)
+        for i in range(self._n_text):
+            value = values[i]
+            if isinstance(value, str) and _UNSAFE_TEXT.search(value) is None:
+                continue
+            problem = problem or f'{self._names[i]}: ' + ('missing' if value is None else 'unsafe text')
+            if self.text_policy == 'reject':
+                if value is not None:
+                    log.error(f'SQL injection detected! Input: {row}')
+                return problem, None
+            values[i] = self._repair_text(value)
+        for i in range(self._n_text, len(values)):
+            try:
+                values[i] = self._to_int(values[i])
+            except ValueError as ex:
+                problem = problem or f'{self._names[i]}: {ex}'
+                if self.int_policy == 'reject':
+                    return problem, None
+                values[i] = self._repair_int(values[i])
+        return problem, tuple(values)
+
+    def close(self, keep: bool = True):
+        """Closes the quarantine and logs the counts, see Quarantine.close."""
+        if self.quarantine is not None:
+            self.quarantine.close(keep)
+        msg = f'Validated {self.rows} rows: {self.rejected} rejected, {self.repaired} repaired'
+        if self.quarantine is not None and self.rejected:
+            msg += f', rejects are in {self.quarantine.file_path}'
+        log.info(msg)
+        for problem, count in self.problems.most_common():
+            log.warning(f'Invalid rows: {count}, {problem}')
@@ -0,0 +1,136 @@
+"""xml_input.py: Input handler for XML files of <objects> records."""
+
+import io
+import os
+import logging
+import xml.etree.ElementTree as et
+from handlers import BaseInputHandler, find_in_file, rfind_in_file
+
+log = logging.getLogger('ETL_logger')
+
+
+def _iter_xml_objects(source):
+    """Yields {name: value} of every <objects> record from the xml file (path or file object)."""
+    data = {}
+    # an element is complete, with its text and children, at its end
+    for _, elem in et.iterparse(source):
+        tag = elem.tag
+        if tag == 'object':
+            value = elem.find('value')
+            if value is not None:
+                data[elem.get('name')] = value.text
+        elif tag == 'objects':
+            yield data
+            data = {}
+            # keep memory constant
+            elem.clear()
+
+
+def _parse_xml_range(file_path: str, start: int, end: int, prolog: bytes, keys: tuple):
+    """
+    Parses complete <objects> records found in the byte range of the file.
+
+    Runs in a worker process. Returns the number of records,
+    [(record number in the range, row)] and [(message, detail)] for invalid records.
+    """
+    with open(file_path, 'rb') as xml_input:
+        xml_input.seek(start)
+        fragment = xml_input.read(end - start)
+    fragment = io.BytesIO(prolog + b'<xml_range>' + fragment + b'</xml_range>')
+    records = 0
+    rows = []
+    errors = []
+    for data in _iter_xml_objects(fragment):
+        records += 1
+        try:
+            rows.append((records, tuple(data[key] for key in keys)))
+        except Exception as ex:
+            errors.append((f'Unable to load data from xml object! {ex}',
+                           f'Input data: {data} Expected: {keys}'))
+    return records, rows, errors
+
+
+class XmlInputHandler(BaseInputHandler):
+    """
+    Yields "rows" from the given xml file as tuple incrementally.
+
+    Positions are numbers of processed <objects> records: ElementTree doesn't
+    report byte offsets, so on resume the processed records are parsed and skipped.
+
+    With a pool the file is split into byte ranges of about chunk_size ending
+    right after a </objects> tag. The ranges are parsed as separate fragments in
+    the process pool, rows come back in batches, in the order of the file.
+    """
+    RECORD_START = b'<objects'
+    RECORD_END = b'</objects>'
+
+    def __init__(self, file_path: str, fields: tuple, pool=None,
+                 chunk_size: int = 4 * 1024 * 1024):
+        self.pool = pool
+        self.chunk_size = chunk_size
+        super().__init__(file_path, fields)
+
+    def wants_pool(self):
+        # a pool isn't worth it for a single range
+        return os.path.getsize(self.file_path) > self.chunk_size
+
+    def get_positioned_gen(self, start=None):
+        """Yields (position, row) from the given xml file incrementally."""
+        if self.pool is not None and self.wants_pool():
+            yield from self._get_parallel_positioned_gen(start)
+            return
+        keys = self.fields[0] + self.fields[1]
+        skip = start or 0
+        for records, data in enumerate(_iter_xml_objects(self.file_path), 1):
+            if records <= skip:
+                continue
+            try:
+                nice_data = tuple(data[key] for key in keys)
+            except Exception as ex:
+                msg = f'Unable to load data from xml object! {ex}'
+                detail = f'Input data: {data} Expected: {keys}'
+                log.warning(msg)
+                log.warning(detail)
+            else:
+                yield records, nice_data
+
+    def get_record_ranges(self):
+        """Returns the xml declaration and [(start, end)] byte ranges of complete records."""
+        with open(self.file_path, 'rb') as xml_input:
+            head = xml_input.read(1024)
+            prolog = head[:head.find(b'?>') + 2] if head.lstrip().startswith(b'<?xml') else b''
+            # '<objects' followed by '>' or a space, not '<objectsX'
+            first = find_in_file(xml_input, self.RECORD_START, 0)
+            while first != -1:
+                xml_input.seek(first + len(self.RECORD_START))
+                if xml_input.read(1) in (b'>', b' ', b'\t', b'\r', b'\n'):
+                    break
+                first = find_in_file(xml_input, self.RECORD_START, first + 1)
+            last = rfind_in_file(xml_input, self.RECORD_END)
+            if first == -1 or last == -1:
+                return prolog, []
+            last += len(self.RECORD_END)
+            ranges = []
+            pos = first
+            while pos < last:
+                end = find_in_file(xml_input, self.RECORD_END, pos + self.chunk_size)
+                end = last if end == -1 else min(last, end + len(self.RECORD_END))
+                ranges.append((pos, end))
+                pos = end
+        return prolog, ranges
+
+    def _get_parallel_positioned_gen(self, start=None):
+        keys = self.fields[0] + self.fields[1]
+        skip = start or 0
+        prolog, ranges = self.get_record_ranges()
+        args = ((self.file_path, range_start, range_end, prolog, keys)
+                for range_start, range_end in ranges)
+        done = 0
+        for records, rows, errors in self.pool.map(_parse_xml_range, args):
+            for msg, detail in errors:
+                log.warning(msg)
+                log.warning(detail)
+            for number, nice_data in rows:
+                if done + number > skip:
+                    yield done + number, nice_data
+            done += records
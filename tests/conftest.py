@@ -0,0 +1,6 @@
+"""conftest.py: The modules in src are imported the way main.py imports them."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
@@ -0,0 +1,99 @@
+"""test_checkpoints.py: Interrupted and completed checkpointed loads of DbWriter."""
+
+import itertools
+import sqlite3
+
+import pytest
+
+from csv_input import CsvInputHandler
+from handlers import DbWriter
+from validation import RowValidator
+
+FIELDS = (['D1'], ['M1'])
+ROWS = 20
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after(it, n):
+    yield from itertools.islice(it, n)
+    raise Interrupted
+
+
+@pytest.fixture
+def sources(tmp_path):
+    sources = []
+    for name in ('a', 'b'):
+        path = tmp_path / f'{name}.csv'
+        path.write_text('D1,M1\n' + ''.join(f'{name}{i},{i}\n' for i in range(ROWS)))
+        sources.append(CsvInputHandler(str(path), FIELDS))
+    return sources
+
+
+def make_writer(tmp_path, validator=None):
+    db = DbWriter(str(tmp_path / 'db.sqlite3'), FIELDS, validator)
+    db.insert_counter_limit = 3
+    return db
+
+
+def load(db, sources, checkpoints):
+    db.write_checkpointed(itertools.chain(*(src.get_checkpointed_gen(checkpoints.get(src.source_id))
+                                            for src in sources)))
+
+
+def loaded_rows(db):
+    con = sqlite3.connect(db.file_path)
+    try:
+        return con.execute('SELECT D1, M1 FROM important_data ORDER BY rowid').fetchall()
+    finally:
+        con.close()
+
+
+def expected_rows():
+    return [(f'{name}{i}', i) for name in ('a', 'b') for i in range(ROWS)]
+
+
+@pytest.mark.parametrize('interrupt', range(2 * ROWS))
+def test_resumed_load_has_every_row_once(tmp_path, sources, interrupt):
+    db = make_writer(tmp_path)
+    db.create_table()
+    all_items = itertools.chain(*(src.get_checkpointed_gen() for src in sources))
+    with pytest.raises(Interrupted):
+        db.write_checkpointed(interrupt_after(all_items, interrupt))
+
+    db = make_writer(tmp_path)
+    checkpoints = db.load_checkpoints(sources)
+    db.create_table(keep_existing=bool(checkpoints))
+    load(db, sources, checkpoints)
+    assert loaded_rows(db) == expected_rows()
+
+
+def test_completed_load_is_not_resumed(tmp_path, sources):
+    db = make_writer(tmp_path)
+    db.create_table()
+    load(db, sources, {})
+    assert db.load_checkpoints(sources) == {}
+
+
+def interrupted_load(tmp_path, sources):
+    db = make_writer(tmp_path)
+    db.create_table()
+    all_items = itertools.chain(*(src.get_checkpointed_gen() for src in sources))
+    with pytest.raises(Interrupted):
+        db.write_checkpointed(interrupt_after(all_items, ROWS + 5))
+    assert db.load_checkpoints(sources)
+
+
+def test_changed_policy_is_not_resumed(tmp_path, sources):
+    interrupted_load(tmp_path, sources)
+    db = make_writer(tmp_path, RowValidator(FIELDS, int_policy='repair'))
+    assert db.load_checkpoints(sources) == {}
+
+
+def test_changed_source_is_not_resumed(tmp_path, sources):
+    interrupted_load(tmp_path, sources)
+    with open(sources[0].file_path, 'a') as f:
+        f.write('c0,0\n')
+    assert make_writer(tmp_path).load_checkpoints(sources) == {}
@@ -0,0 +1,121 @@
+"""test_input_handlers.py: Reading from every position an input handler reports."""
+
+import json
+
+import pytest
+
+import json_input
+from csv_input import CsvInputHandler
+from json_input import JsonInputHandler
+from ndjson_input import NdjsonInputHandler
+from xml_input import XmlInputHandler
+from pipeline import ProcessPool, can_fork
+
+FIELDS = (['D1', 'D2'], ['M1'])
+# non-ASCII text, separators and quotes inside values, a record with a missing field
+RECORDS = [{'D1': 'a', 'D2': 'x', 'M1': 1},
+           {'D1': 'ä€', 'D2': 'y, "z"', 'M1': 2},
+           {'D1': 'b', 'M1': 3},
+           {'D1': 'c\nd', 'D2': 'ü' * 40, 'M1': -4}] + \
+          [{'D1': f'k{i}', 'D2': 'é' * (i % 7), 'M1': i} for i in range(30)]
+# small enough to split the files into several ranges
+CHUNK_SIZE = 200
+
+
+@pytest.fixture(scope='module')
+def pool():
+    if not can_fork():
+        pytest.skip('process pools need the fork start method')
+    with ProcessPool(2) as pool:
+        yield pool
+
+
+def write_csv(path):
+    def quote(value):
+        return '"' + str(value).replace('"', '""') + '"'
+    lines = ['D1,D2,M1'] + [','.join(quote(r[k]) if k in r else '' for k in ('D1', 'D2', 'M1'))
+                            for r in RECORDS]
+    path.write_bytes('\r\n'.join(lines).encode('utf-8') + b'\r\n')
+
+
+def write_json(path):
+    path.write_text(json.dumps({'fields': RECORDS}, ensure_ascii=False, indent=1), encoding='utf-8')
+
+
+def write_ndjson(path):
+    path.write_text(''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in RECORDS),
+                    encoding='utf-8')
+
+
+def write_xml(path):
+    records = []
+    for r in RECORDS:
+        objects = ''.join(f'<object name="{k}"><value>{v}</value></object>' for k, v in r.items())
+        records.append(f'<objects>{objects}</objects>\n')
+    path.write_text('<?xml version="1.0" encoding="utf-8"?>\n<root>\n' + ''.join(records) + '</root>\n',
+                    encoding='utf-8')
+
+
+def check_resume(handler):
+    """Reading from every reported position gives exactly the rows after it."""
+    full = list(handler.get_positioned_gen())
+    assert [row for _, row in full] == list(handler.get_row_gen())
+    for i, (position, _) in enumerate(full):
+        assert list(handler.get_positioned_gen(position)) == full[i + 1:]
+        assert list(handler.get_row_gen(position)) == [row for _, row in full[i + 1:]]
+    return [row for _, row in full]
+
+
+def expected_rows(convert=str):
+    keys = FIELDS[0] + FIELDS[1]
+    return [tuple(convert(r[k]) for k in keys) for r in RECORDS if all(k in r for k in keys)]
+
+
+def test_csv_resume(tmp_path):
+    path = tmp_path / 'a.csv'
+    write_csv(path)
+    rows = check_resume(CsvInputHandler(str(path), FIELDS))
+    # an empty value isn't a missing one in csv
+    assert rows[2] == ('b', '', '3')
+    assert [row for i, row in enumerate(rows) if i != 2] == expected_rows()
+
+
+@pytest.mark.parametrize('chunk_size', [7, 64 * 1024])
+def test_json_resume(tmp_path, monkeypatch, chunk_size):
+    path = tmp_path / 'a.json'
+    write_json(path)
+    # chunks of a few characters end inside multi-byte ones and mix ASCII and non-ASCII chunks
+    monkeypatch.setattr(json_input._OffsetCharReader.__init__, '__defaults__', ('', chunk_size))
+    assert check_resume(JsonInputHandler(str(path), FIELDS)) == expected_rows()
+
+
+def test_ndjson_resume(tmp_path):
+    path = tmp_path / 'a.ndjson'
+    write_ndjson(path)
+    handler = NdjsonInputHandler(str(path), FIELDS, chunk_size=CHUNK_SIZE)
+    assert check_resume(handler) == expected_rows()
+
+
+def test_ndjson_resume_pooled(tmp_path, pool):
+    path = tmp_path / 'a.ndjson'
+    write_ndjson(path)
+    handler = NdjsonInputHandler(str(path), FIELDS, pool=pool, chunk_size=CHUNK_SIZE)
+    assert len(handler.get_line_ranges()) > 1
+    assert check_resume(handler) == expected_rows()
+
+
+def test_xml_resume(tmp_path):
+    path = tmp_path / 'a.xml'
+    write_xml(path)
+    handler = XmlInputHandler(str(path), FIELDS, chunk_size=CHUNK_SIZE)
+    # ElementTree gives None for an empty element
+    assert check_resume(handler) == expected_rows(lambda v: str(v) or None)
+
+
+def test_xml_resume_pooled(tmp_path, pool):
+    path = tmp_path / 'a.xml'
+    write_xml(path)
+    handler = XmlInputHandler(str(path), FIELDS, pool=pool, chunk_size=CHUNK_SIZE)
+    assert handler.wants_pool() and len(handler.get_record_ranges()[1]) > 1
+    # ElementTree gives None for an empty element
+    assert check_resume(handler) == expected_rows(lambda v: str(v) or None)
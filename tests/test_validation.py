@@ -0,0 +1,71 @@
+"""test_validation.py: The columnar fast path of RowValidator against the per-row one."""
+
+import random
+
+import pytest
+
+from validation import RowValidator, Quarantine, INT_MIN, INT_MAX
+
+FIELDS = (['D1', 'D2'], ['M1', 'M2'])
+TEXTS = ['a', '', 'ä€', 'a b', 'a-b', 'a/*b', 'x--y', 'a;b', '/**/', '-', None, 5]
+INTS = ['0', '-0', '7', '-7', '01', '+3', ' 4', '5 ', '1.5', '1e3', 'x', '', None, 12, True,
+        str(INT_MAX), str(INT_MIN), str(INT_MAX + 1), str(INT_MIN - 1), '9' * 18, '9' * 19]
+POLICIES = [(text, int_) for text in RowValidator.POLICIES for int_ in RowValidator.POLICIES]
+
+
+def make_batches(seed, values_per_column, count=200, size=5):
+    rnd = random.Random(seed)
+    batches = []
+    for _ in range(count):
+        batch = []
+        for _ in range(size):
+            row = tuple(rnd.choice(values) for values in values_per_column)
+            # now and then a row of a wrong length
+            if rnd.random() < 0.02:
+                row = row[:-1]
+            batch.append(row)
+        batches.append(batch)
+    return batches
+
+
+def fast_and_slow(validator, batch):
+    """Results of validate and of the per-row path for the same batch."""
+    return validator.validate(list(batch)), validator._validate_rows(list(batch))
+
+
+@pytest.mark.parametrize('text_policy, int_policy', POLICIES)
+@pytest.mark.parametrize('int_range', [(INT_MIN, INT_MAX), (-5, 10)])
+def test_fast_path_equals_slow_path(text_policy, int_policy, int_range):
+    validator = RowValidator(FIELDS, text_policy, int_policy, *int_range)
+    # mostly clean batches, so the fast path is taken often
+    clean = make_batches(1, [TEXTS[:5], TEXTS[:5], INTS[:4], INTS[:4]])
+    mixed = make_batches(2, [TEXTS, TEXTS, INTS, INTS])
+    for batch in clean + mixed:
+        fast, slow = fast_and_slow(validator, batch)
+        # the fast path passes M values as they are: only canonical ones,
+        # which SQLite (and to_sql_number) turn into the same ints
+        assert [tuple(str(v) if i >= 2 and isinstance(v, int) else v for i, v in enumerate(row))
+                for row in slow] == [tuple(str(v) if i >= 2 and isinstance(v, int) else v
+                                           for i, v in enumerate(row)) for row in fast]
+
+
+def test_clean_batch_is_passed_as_is():
+    validator = RowValidator(FIELDS)
+    batch = [('a', 'b', '0', '-12'), ('c', 'd', '9' * 18, '-' + '9' * 18)]
+    assert validator.validate(batch) is batch
+
+
+@pytest.mark.parametrize('value, expected', [('-0', 0), ('00', 0), ('+1', 1), (' 2 ', 2)])
+def test_non_canonical_int_is_converted(value, expected):
+    validator = RowValidator(FIELDS)
+    assert validator.validate([('a', 'b', value, '1')]) == [('a', 'b', expected, 1)]
+
+
+def test_rejects_go_to_quarantine(tmp_path):
+    path = tmp_path / 'quarantine.csv'
+    validator = RowValidator(FIELDS, quarantine=Quarantine(str(path), FIELDS))
+    rows = validator.validate([('a', 'b', '1', '2'), ('a;', 'b', '1', '2'), ('a', 'b', 'x', '2')])
+    validator.close()
+    assert rows == [('a', 'b', 1, 2)]
+    assert (validator.rows, validator.rejected, validator.repaired) == (3, 2, 0)
+    assert path.read_text().splitlines()[1:] == ['a;,b,1,2,D1: unsafe text', 'a,b,x,2,M1: not an integer']